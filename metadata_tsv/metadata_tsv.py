@@ -14,6 +14,7 @@ genomeregion1
 
 from pathlib import Path
 import argparse
+import re
 
 
 def parameter_parser():
@@ -83,7 +84,8 @@ def make_tsv(parameters):
     annotation = parameters.annotation
     value = parameters.value
 
-    include_list = parameters.include
+    # drop repeated strings so each one is only checked once
+    include_list = list(dict.fromkeys(parameters.include))
  
     # Scan input folder for gbk files
     gbk_list = list(input_folder.glob("**/*.gbk"))
@@ -92,24 +94,25 @@ def make_tsv(parameters):
         exit()
 
     # validate list with allowed substrings
-    gbk_validated = []
-    for gbk in gbk_list:
-        if len(include_list) == 0:
-            gbk_validated.append(gbk)
-        else:
-            for include_string in include_list:
-                if include_string in gbk.name:
-                    gbk_validated.append(gbk)
-                    break
+    if len(include_list) == 0:
+        gbk_validated = gbk_list
+    elif len(include_list) == 1:
+        include_string = include_list[0]
+        gbk_validated = [gbk for gbk in gbk_list if include_string in gbk.name]
+    else:
+        # one compiled, C-level search per name instead of a Python loop over
+        # the strings (re still tries each alternative at every position)
+        include_pattern = re.compile("|".join(map(re.escape, include_list)))
+        gbk_validated = [
+            gbk for gbk in gbk_list if include_pattern.search(gbk.name)
+        ]
 
     print(f"Found {len(gbk_validated)} gbk files")
 
-    output_folder = Path(tsv_path.parent)
-    output_folder.mkdir(parents=True, exist_ok=True)
-    with open(tsv_path, "w") as tsv:
+    tsv_path.parent.mkdir(parents=True, exist_ok=True)
+    with open(tsv_path, "w", buffering=1 << 16, newline="") as tsv:
         tsv.write(f"Region\t{annotation}\n")
-        for gbk in gbk_validated:
-            tsv.write(f"{gbk.stem}\t{value}\n")
+        tsv.writelines(f"{gbk.stem}\t{value}\n" for gbk in gbk_validated)
 
 
 def main():
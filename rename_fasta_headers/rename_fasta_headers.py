@@ -4,9 +4,16 @@
 Renames fasta headers that start with 'contig', adding the filename in front
 """
 
+import mmap
+import os
+import shutil
 from pathlib import Path
 from argparse import ArgumentParser
-from collections import defaultdict
+from concurrent.futures import ProcessPoolExecutor
+from functools import lru_cache, partial
+from queue import Queue
+from tempfile import NamedTemporaryFile
+from threading import Thread
 
 __author__ = "Jorge Navarro"
 __version__ = "1.0"
@@ -43,44 +50,171 @@ def parameter_parser():
         action="store_true",
         help="Prints all filenames that were fixed",
     )
+    parser.add_argument(
+        "-p",
+        "--processes",
+        help="Number of files to process in parallel. Default: all available \
+            cores, or at most 4 when modifying files in-place",
+        type=int,
+    )
 
     return parser.parse_args()
 
 
+def find_files(input_folder: Path, extensions: tuple, threads=16):
+    """
+    Recursively looks for files ending with any of the given extensions (e.g.
+    ".fasta"), in a single pass over the folder tree. Folders are read
+    concurrently by a pool of threads, which hides the latency of each folder
+    listing on network filesystems. Files are yielded as soon as they are found
+    """
+
+    folder_queue = Queue()
+    found_files = Queue()
+
+    def worker():
+        while True:
+            folder = folder_queue.get()
+            if folder is None:
+                break
+            try:
+                with os.scandir(folder) as entries:
+                    for entry in entries:
+                        if entry.is_dir(follow_symlinks=False):
+                            folder_queue.put(entry.path)
+                        elif entry.name.endswith(extensions) \
+                                and entry.is_file():
+                            found_files.put(Path(entry.path))
+            except OSError:
+                # unreadable folders are skipped, like Path.glob does
+                pass
+            finally:
+                folder_queue.task_done()
+
+    def stop_when_done():
+        folder_queue.join()
+        for _ in workers:
+            folder_queue.put(None)
+        found_files.put(None)
+
+    workers = [Thread(target=worker, daemon=True) for _ in range(threads)]
+    for thread in workers:
+        thread.start()
+
+    folder_queue.put(str(input_folder))
+    Thread(target=stop_when_done, daemon=True).start()
+
+    yield from iter(found_files.get, None)
+
+
 def collect_files(input_folder: Path) -> list:
     """
     Collects all files and makes sure filenames are unique
     """
 
-    allowed_extensions = {"fasta"}
+    if not input_folder.is_dir():
+        exit(f"Error: invalid input folder {input_folder}")
 
-    filename_count = defaultdict(list)
-    paths_files = []
-    for extension in allowed_extensions:
-        paths_files.extend(input_folder.glob(f"**/*.{extension}"))
+    allowed_extensions = (".fasta",)
 
-    # keep a counter of how many file paths match a given filename
-    for file_path in paths_files:
+    # remember where each filename was first seen; paths are only grouped
+    # for filenames that turn out to be repeated
+    paths_files = []
+    first_paths = {}
+    duplicates = {}
+    for file_path in find_files(input_folder, allowed_extensions):
+        paths_files.append(file_path)
         filename = file_path.stem
-        filename_count[filename].append(file_path)
+        first_path = first_paths.setdefault(filename, file_path)
+        if first_path is not file_path:
+            duplicates.setdefault(filename, [first_path]).append(file_path)
 
     # stop if filenames are not unique (notice extension could be different)
-    max_filename_count = max([len(x) for x in filename_count.values()])
-    if max_filename_count > 1:
+    if duplicates:
         print("Error: Some filenames are not unique!")
-        for filename, file_paths in filename_count.items():
-            if len(file_paths) > 1:
-                print(f"{filename}:")
-                for file_path in file_paths:
-                    print(f"\t{file_path}")
+        # folders are walked in parallel, sort to always print the same
+        for filename in sorted(duplicates):
+            print(f"{filename}:")
+            for file_path in sorted(duplicates[filename]):
+                print(f"\t{file_path}")
         exit()
 
     return paths_files
 
 
-def create_fixed_fasta(
-    fasta_file: Path, base_output_folder: Path, verbose=False
-) -> bool:
+def find_headers(data):
+    """
+    Yields the position of every '>' that begins a line
+    """
+
+    if data[:1] == b">":
+        yield 0
+
+    position = data.find(b"\n>")
+    while position != -1:
+        yield position + 1
+        position = data.find(b"\n>", position + 1)
+
+
+def fix_headers(fasta, out, new_prefix: bytes) -> bool:
+    """
+    Copies an open fasta file (binary mode) to `out`, inserting `new_prefix`
+    in front of the headers that start with 'contig'
+    The file is memory-mapped: only header lines are looked at, everything
+    in between is written in one go
+
+    Output (bool): whether any header was fixed
+    """
+
+    if os.fstat(fasta.fileno()).st_size == 0:
+        return False
+
+    header_fixed = False
+    with mmap.mmap(fasta.fileno(), 0, access=mmap.ACCESS_READ) as data, \
+            memoryview(data) as view:
+        # everything before this position has already been written
+        copied = 0
+
+        for header_start in find_headers(data):
+            header_end = data.find(b"\n", header_start)
+            if header_end == -1:
+                header_end = len(data)
+
+            header = data[header_start + 1:header_end].lstrip()
+            if header[:6].lower() == b"contig":
+                header_fixed = True
+                out.write(view[copied:header_start])
+                out.write(new_prefix)
+                out.write(header)
+                copied = header_end
+
+        out.write(view[copied:])
+
+    return header_fixed
+
+
+@lru_cache(maxsize=None)
+def make_folder(folder: Path) -> Path:
+    """
+    Creates a folder (and its parents). Each worker process remembers which
+    folders it already made, so mkdir is only called once per folder instead
+    of once per file
+    """
+
+    folder.mkdir(parents=True, exist_ok=True)
+    return folder
+
+
+def get_output_folder(file_path: Path, base_output_folder: Path) -> Path:
+    """
+    Folder where the copy of a file goes, re-creating the folder structure
+    within the input folder
+    """
+
+    return base_output_folder.joinpath(*file_path.parts[1:-1])
+
+
+def create_fixed_fasta(fasta_file: Path, base_output_folder: Path) -> bool:
     """
     Opens and scans a fasta file, inserting the filename to the header if
     it starts with 'contig'
@@ -89,27 +223,20 @@ def create_fixed_fasta(
     Output (bool): whether any header was fixed
     """
 
-    header_fixed = False
-    output_folder = base_output_folder / Path("/".join(fasta_file.parts[1:-1]))
-    output_folder.mkdir(parents=True, exist_ok=True)
-    with open(fasta_file) as fasta, open(output_folder / fasta_file.name, "w") as out:
-        fasta_stem = fasta_file.stem
-        for line in fasta:
-            if line[0] == ">":
-                if line[1:].lstrip().lower().startswith("contig"):
-                    header_fixed = True
-                    out.write(f">{fasta_stem}_{line[1:].lstrip()}")
-                    continue
-
-            out.write(line)
-
-    if verbose:
-        print(output_folder / fasta_file.name)
+    output_folder = make_folder(
+        get_output_folder(fasta_file, base_output_folder)
+    )
+    with open(fasta_file, "rb") as fasta, open(
+        output_folder / fasta_file.name, "wb", buffering=1 << 20
+    ) as out:
+        # fasta files are plain ASCII, no need to decode them
+        new_prefix = f">{fasta_file.stem}_".encode()
+        header_fixed = fix_headers(fasta, out, new_prefix)
 
     return header_fixed
 
 
-def modify_in_place(fasta_file: Path, verbose=False) -> bool:
+def modify_in_place(fasta_file: Path) -> bool:
     """
     Opens and scans a fasta file, inserting the filename to the header if
     it starts with 'contig'
@@ -118,27 +245,43 @@ def modify_in_place(fasta_file: Path, verbose=False) -> bool:
     Output (bool): whether any header was fixed
     """
 
-    header_fixed = False
+    # stream into a temporary file next to the original and swap it in at the
+    # end, so the whole file never has to be held in memory. Symlinks are
+    # resolved so that the file they point to is the one modified
+    real_file = Path(os.path.realpath(fasta_file))
+    with open(real_file, "rb") as fasta, NamedTemporaryFile(
+        "wb", dir=real_file.parent, delete=False, buffering=1 << 20
+    ) as out:
+        try:
+            # fasta files are plain ASCII, no need to decode them
+            new_prefix = f">{fasta_file.stem}_".encode()
+            header_fixed = fix_headers(fasta, out, new_prefix)
+        except BaseException:
+            out.close()
+            os.unlink(out.name)
+            raise
+
+    shutil.copymode(real_file, out.name)
+    os.replace(out.name, real_file)
 
-    modified_data = []
-    with open(fasta_file) as fasta:
-        fasta_stem = fasta_file.stem
-        for line in fasta:
-            if line[0] == ">":
-                if line[1:].lstrip().lower().startswith("contig"):
-                    header_fixed = True
-                    modified_data.append(f">{fasta_stem}_{line[1:].lstrip()}")
-                    continue
+    return header_fixed
 
-            modified_data.append(line)
 
-    with open(fasta_file, "w") as fasta:
-        fasta.write("".join(modified_data))
+def get_processes(processes, output_folder) -> int:
+    """
+    Number of worker processes to use. Files are independent, so by default
+    all cores are used; in-place modification is limited by the disk instead
+    """
 
-    if verbose:
-        print(fasta_file)
+    if processes is not None:
+        if processes < 1:
+            exit("Error: number of processes must be at least 1")
+        return processes
 
-    return header_fixed
+    cores = os.cpu_count() or 1
+    if output_folder:
+        return cores
+    return min(4, cores)
 
 
 def main():
@@ -149,14 +292,29 @@ def main():
 
     # create files if output folder specified
     if parameters.outputfolder:
-        # create folder if necessary
-        for fasta_file in file_list:
-            create_fixed_fasta(fasta_file, parameters.outputfolder, parameters.verbose)
+        worker = partial(
+            create_fixed_fasta, base_output_folder=parameters.outputfolder
+        )
 
     # otherwise, modify existing files
     else:
-        for fasta_file in file_list:
-            modify_in_place(fasta_file, parameters.verbose)
+        worker = modify_in_place
+
+    processes = get_processes(parameters.processes, parameters.outputfolder)
+    chunksize = max(1, len(file_list) // (4 * processes))
+    with ProcessPoolExecutor(max_workers=processes) as executor:
+        list(executor.map(worker, file_list, chunksize=chunksize))
+
+    # files are finished in any order; list them sorted once all are done
+    if parameters.verbose:
+        for fasta_file in sorted(file_list):
+            if parameters.outputfolder:
+                output_folder = get_output_folder(
+                    fasta_file, parameters.outputfolder
+                )
+                print(output_folder / fasta_file.name)
+            else:
+                print(fasta_file)
 
 
 if __name__ == "__main__":
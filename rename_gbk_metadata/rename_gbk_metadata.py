@@ -8,17 +8,32 @@ option --external).
 It also updates the date.
 """
 
+import os
+import re
+import shutil
 from pathlib import Path
 from argparse import ArgumentParser
-from collections import defaultdict
-from Bio import SeqIO
+from concurrent.futures import ProcessPoolExecutor
+from functools import lru_cache, partial
+from queue import Queue
 from datetime import date
+from tempfile import NamedTemporaryFile
+from threading import Thread
 
 __author__ = "Jorge Navarro"
 __version__ = "1.1"
 __maintainer__ = "Jorge Navarro"
 __email__ = "jorge.navarromunoz@wur.nl"
 
+# keyword, entry, spacing after the entry and rest of a header line
+HEADER_LINE = re.compile(r"(\S+\s+)(\S+)( *)(.*)")
+# date at the end of a LOCUS line, e.g. 27-JUN-2023
+LOCUS_DATE = re.compile(r"\d{2}-[A-Z]{3}-\d{4}$")
+# Month abbreviation *must* be capitalized
+TODAY = date.today().strftime('%d-%b-%Y').upper()
+# external dictionary of each worker process (see init_worker)
+worker_substitute_strings = {}
+
 
 def parameter_parser():
     parser = ArgumentParser(
@@ -55,6 +70,13 @@ def parameter_parser():
         action="store_true",
         help="Updates date in GenBank headers to today"
     )
+    parser.add_argument(
+        "-p",
+        "--processes",
+        help="Number of files to process in parallel. Default: all available \
+            cores, or at most 4 when modifying files in-place",
+        type=int,
+    )
 
     parser.add_argument(
         "-e",
@@ -69,32 +91,82 @@ def parameter_parser():
     return parser.parse_args()
 
 
+def find_files(input_folder: Path, extensions: tuple, threads=16):
+    """
+    Recursively looks for files ending with any of the given extensions (e.g.
+    ".gbk"), in a single pass over the folder tree. Folders are read
+    concurrently by a pool of threads, which hides the latency of each folder
+    listing on network filesystems. Files are yielded as soon as they are found
+    """
+
+    folder_queue = Queue()
+    found_files = Queue()
+
+    def worker():
+        while True:
+            folder = folder_queue.get()
+            if folder is None:
+                break
+            try:
+                with os.scandir(folder) as entries:
+                    for entry in entries:
+                        if entry.is_dir(follow_symlinks=False):
+                            folder_queue.put(entry.path)
+                        elif entry.name.endswith(extensions) \
+                                and entry.is_file():
+                            found_files.put(Path(entry.path))
+            except OSError:
+                # unreadable folders are skipped, like Path.glob does
+                pass
+            finally:
+                folder_queue.task_done()
+
+    def stop_when_done():
+        folder_queue.join()
+        for _ in workers:
+            folder_queue.put(None)
+        found_files.put(None)
+
+    workers = [Thread(target=worker, daemon=True) for _ in range(threads)]
+    for thread in workers:
+        thread.start()
+
+    folder_queue.put(str(input_folder))
+    Thread(target=stop_when_done, daemon=True).start()
+
+    yield from iter(found_files.get, None)
+
+
 def collect_files(input_folder):
     """
     Collects all files and makes sure filenames are unique
     """
 
-    allowed_extensions = {"gb", "gbk", "gbff"}
+    if not input_folder.is_dir():
+        exit(f"Error: invalid input folder {input_folder}")
 
-    filename_count = defaultdict(list)
-    paths_files = []
-    for extension in allowed_extensions:
-        paths_files.extend(input_folder.glob(f"**/*.{extension}"))
+    allowed_extensions = (".gb", ".gbk", ".gbff")
 
-    # keep a counter of how many file paths match a given filename
-    for file_path in paths_files:
+    # remember where each filename was first seen; paths are only grouped
+    # for filenames that turn out to be repeated
+    paths_files = []
+    first_paths = {}
+    duplicates = {}
+    for file_path in find_files(input_folder, allowed_extensions):
+        paths_files.append(file_path)
         filename = file_path.stem
-        filename_count[filename].append(file_path)
+        first_path = first_paths.setdefault(filename, file_path)
+        if first_path is not file_path:
+            duplicates.setdefault(filename, [first_path]).append(file_path)
 
     # stop if filenames are not unique (notice extension could be different)
-    max_filename_count = max([len(x) for x in filename_count.values()])
-    if max_filename_count > 1:
+    if duplicates:
         print("Error: Some filenames are not unique!")
-        for filename, file_paths in filename_count.items():
-            if len(file_paths) > 1:
-                print(f"{filename}:")
-                for file_path in file_paths:
-                    print(f"\t{file_path}")
+        # folders are walked in parallel, sort to always print the same
+        for filename in sorted(duplicates):
+            print(f"{filename}:")
+            for file_path in sorted(duplicates[filename]):
+                print(f"\t{file_path}")
         exit()
 
     return paths_files
@@ -127,9 +199,101 @@ def parse_dict_file(external_dict_file:Path) -> dict:
     return original_to_substitute
 
 
+def rewrite_header_line(
+    line: str, filename: str, substitute: str, update_date=False
+) -> str:
+    """
+    Rewrites the entry of a LOCUS, ACCESSION or VERSION line (the first value
+    after the keyword), keeping the rest of the line in place. In LOCUS lines,
+    the date at the end of the line can also be updated
+
+    Output (str): the (possibly) modified line
+    """
+
+    body = line.rstrip("\r\n")
+    line_end = line[len(body):]
+
+    match = HEADER_LINE.fullmatch(body)
+    if match is None:
+        # keyword without a value
+        return line
+    keyword, entry, gap, rest = match.groups()
+
+    # Forcibly replace string if external dictionary provided
+    if substitute is not None:
+        new_entry = substitute
+    # else, simply append filename at the beginning
+    elif entry.startswith(filename):
+        new_entry = entry
+    else:
+        new_entry = f"{filename}_{entry}"
+
+    # keep the following columns aligned while there is room for it
+    if rest:
+        gap = " " * max(1, len(gap) - len(new_entry) + len(entry))
+
+    if update_date and keyword.rstrip() == "LOCUS":
+        date_match = LOCUS_DATE.search(rest)
+        if date_match is not None:
+            rest = rest[:date_match.start()] + TODAY
+
+    return f"{keyword}{new_entry}{gap}{rest}{line_end}"
+
+
+def rewrite_genbank(
+    gb, out, filename: str, substitute: str, update_date=False
+) -> bool:
+    """
+    Copies a genbank file line by line, rewriting only the header lines that
+    hold the locus name, accession and version (and date). Features and
+    sequence are passed through untouched
+
+    Output (bool): whether any header was fixed
+    """
+
+    header_fixed = False
+    for line in gb:
+        if line.startswith(("LOCUS", "ACCESSION", "VERSION")):
+            new_line = rewrite_header_line(
+                line, filename, substitute, update_date
+            )
+            if new_line != line:
+                header_fixed = True
+                line = new_line
+
+        out.write(line)
+
+    return header_fixed
+
+
+@lru_cache(maxsize=None)
+def make_folder(folder: Path) -> Path:
+    """
+    Creates a folder (and its parents). Each worker process remembers which
+    folders it already made, so mkdir is only called once per folder instead
+    of once per file
+    """
+
+    folder.mkdir(parents=True, exist_ok=True)
+    return folder
+
+
+def get_output_file(gb_file: Path, base_output_folder: Path) -> Path:
+    """
+    Path of the modified file: the file itself if no output folder is given,
+    otherwise its copy, re-creating the folder structure within the input
+    folder
+    """
+
+    if base_output_folder is None:
+        return gb_file
+
+    return base_output_folder.joinpath(*gb_file.parts[1:])
+
+
 def modify_metadata(
     gb_file: Path, base_output_folder: Path, substitute_strings: dict, 
-    verbose=False, update_date=False,
+    update_date=False,
 ) -> bool:
     """
     Opens and scans a genbank file, inserting the filename in front of the
@@ -142,50 +306,93 @@ def modify_metadata(
 
     filename = gb_file.stem
     prefix = filename.split(".region")[0]
-    header_fixed = False
+    substitute = None
+    if substitute_strings and prefix in substitute_strings:
+        substitute = substitute_strings[prefix]
 
+    output_file = get_output_file(gb_file, base_output_folder)
     if base_output_folder is not None:
-        output_folder = base_output_folder / Path("/".join(gb_file.parts[1:-1]))
-        output_folder.mkdir(parents=True, exist_ok=True)
-        output_file = output_folder / gb_file.name
-    else:
-        output_file = gb_file
+        make_folder(output_file.parent)
+
+    # when modifying in-place, symlinks are resolved so that the file they
+    # point to is the one modified
+    real_file = Path(os.path.realpath(gb_file))
+    with open(real_file, "r", buffering=1 << 20) as gb:
+        # only the first non-blank line is checked; empty files are copied
+        # as they are
+        for line in gb:
+            if line.strip():
+                if not line.startswith("LOCUS"):
+                    exit(f"Error: not able to parse file {gb_file}")
+                break
+        gb.seek(0)
+
+        if base_output_folder is not None:
+            with open(output_file, "w", buffering=1 << 20) as out:
+                header_fixed = rewrite_genbank(
+                    gb, out, filename, substitute, update_date
+                )
+        else:
+            # write next to the original and swap it in once everything is
+            # written
+            with NamedTemporaryFile(
+                "w", dir=real_file.parent, delete=False, buffering=1 << 20
+            ) as out:
+                try:
+                    header_fixed = rewrite_genbank(
+                        gb, out, filename, substitute, update_date
+                    )
+                except BaseException:
+                    out.close()
+                    os.unlink(out.name)
+                    raise
+
+    # the original is only replaced once it has been closed
+    if base_output_folder is None:
+        shutil.copymode(real_file, out.name)
+        os.replace(out.name, real_file)
+
+    return header_fixed
+
+
+def init_worker(substitute_strings: dict):
+    """
+    Keeps the external dictionary in each worker process, so it is sent once
+    per worker instead of with every chunk of files
+    """
 
-    try:
-        records = list(SeqIO.parse(gb_file, "genbank"))
-    except ValueError as e:
-        exit("Error: not able to parse file {gb_file}")
-    else:
-        for record in records:
-            # record.id     modifies *both* ACCESSION and VERSION
-            # record.name   modifies LOCUS
-
-            # Attempt to forcibly replace string if external dictionary provided
-            if substitute_strings and prefix in substitute_strings:
-                record.id = f"{substitute_strings[prefix]}"
-                record.name = f"{substitute_strings[prefix]}"
-                header_fixed = True
+    global worker_substitute_strings
+    worker_substitute_strings = substitute_strings
 
-            # else, simply append filename at the beginning
-            else:
-                if not record.id.startswith(filename):
-                    record.id = f"{filename}_{record.id}"
-                    header_fixed = True
-
-                if not record.name.startswith(filename):
-                    record.name = f"{filename}_{record.name}"
-                    header_fixed = True
-
-            today = date.today().strftime('%d-%b-%Y').upper()
-            if update_date and record.annotations["date"] != today:
-                # Month abbreviation *must* be capitalized
-                record.annotations["date"] = today
-                header_fixed = True
 
-    with open(output_file, "w") as gb:
-        SeqIO.write(records, gb, "genbank")
-        if verbose and header_fixed:
-            print(output_file)
+def modify_metadata_worker(
+    gb_file: Path, base_output_folder: Path, update_date=False,
+) -> bool:
+    """
+    Runs modify_metadata in a worker process, using the external dictionary
+    stored by init_worker
+    """
+
+    return modify_metadata(
+        gb_file, base_output_folder, worker_substitute_strings, update_date,
+    )
+
+
+def get_processes(processes, output_folder) -> int:
+    """
+    Number of worker processes to use. Files are independent, so by default
+    all cores are used; in-place modification is limited by the disk instead
+    """
+
+    if processes is not None:
+        if processes < 1:
+            exit("Error: number of processes must be at least 1")
+        return processes
+
+    cores = os.cpu_count() or 1
+    if output_folder:
+        return cores
+    return min(4, cores)
 
 
 def main():
@@ -200,9 +407,31 @@ def main():
         substitute_strings = parse_dict_file(parameters.external)
 
     # modify files if necessary
-    for gb_file in sorted(file_list):
-        modify_metadata(gb_file, parameters.outputfolder, substitute_strings, 
-                        parameters.verbose, parameters.update_date)
+    worker = partial(
+        modify_metadata_worker,
+        base_output_folder=parameters.outputfolder,
+        update_date=parameters.update_date,
+    )
+    processes = get_processes(parameters.processes, parameters.outputfolder)
+    chunksize = max(1, len(file_list) // (4 * processes))
+    with ProcessPoolExecutor(
+        max_workers=processes,
+        initializer=init_worker,
+        initargs=(substitute_strings,),
+    ) as executor:
+        headers_fixed = list(
+            executor.map(worker, file_list, chunksize=chunksize)
+        )
+
+    # files are finished in any order; list them sorted once all are done
+    if parameters.verbose:
+        modified_files = [
+            gb_file
+            for gb_file, header_fixed in zip(file_list, headers_fixed)
+            if header_fixed
+        ]
+        for gb_file in sorted(modified_files):
+            print(get_output_file(gb_file, parameters.outputfolder))
 
 
 if __name__ == "__main__":